@@ -1,17 +1,25 @@
+import contextlib
 import csv
+import functools
 import io
+import itertools
 import os
+import queue
+import re
 import sqlite3
+import threading
+import time
 from datetime import datetime, timezone, date
-from fastapi import FastAPI, File, UploadFile, HTTPException, Query, Response
+from fastapi import Depends, FastAPI, File, UploadFile, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
-from typing import Optional, Dict, Any
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter, ValidationError, field_validator
+from typing import Optional, Dict, Any, List
 
 APP_DIR = os.path.dirname(__file__)
 DB_PATH = os.path.join(APP_DIR, "invoisa.db")
 
-app = FastAPI(title="Invoisa API")
+app = FastAPI(title="Invoisa API", default_response_class=ORJSONResponse)
 
 # CORS
 app.add_middleware(
@@ -22,118 +30,238 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-def get_conn():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+POOL_SIZE = 8
+
+# SQLite allows one writer at a time; serialize writes in-process instead of
+# letting concurrent requests contend on the file lock.
+WRITE_LOCK = threading.Lock()
+
+class ConnectionPool:
+    """Keeps `size` connections open and reused so their page caches stay warm.
+
+    When every pooled connection is checked out, an extra one is opened rather than
+    waiting: a request blocked here would hold a threadpool worker that the requests
+    holding connections need in order to finish, which can wedge the server.
+    """
+
+    def __init__(self, path: str, size: int = POOL_SIZE):
+        self.path = path
+        self._idle: "queue.Queue[sqlite3.Connection]" = queue.Queue(maxsize=size)
+        for _ in range(size):
+            self._idle.put(self._open())
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        # SQLite's ROUND rounds halves away from zero; enrichment must round like Python
+        conn.create_function("py_round", 2, round, deterministic=True)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA wal_autocheckpoint=1000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-64000")
+        conn.execute("PRAGMA mmap_size=268435456")
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._open()
 
-def init_db():
-    conn = get_conn()
-    cur = conn.cursor()
+    def release(self, conn: sqlite3.Connection) -> None:
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            # an overflow connection opened during a burst
+            conn.close()
+
+POOL = ConnectionPool(DB_PATH)
+
+def retry_if_locked(fn, attempts: int = 3, delay: float = 0.1):
+    """Re-run a write handler when SQLite still reports the database as locked."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        for attempt in range(attempts):
+            try:
+                return fn(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) or attempt == attempts - 1:
+                    raise
+                # start the next attempt from a clean transaction on the same connection
+                db = kwargs.get("db")
+                if db is not None and db.in_transaction:
+                    db.rollback()
+                time.sleep(delay * (attempt + 1))
+    return wrapper
+
+@contextlib.contextmanager
+def pooled():
+    """Borrow a pooled connection, returning it to the pool however the block exits."""
+    conn = POOL.acquire()
+    try:
+        yield conn
+    finally:
+        POOL.release(conn)
+
+def get_db():
+    """FastAPI dependency: lends a pooled connection for the duration of a request."""
+    with pooled() as conn:
+        yield conn
+
+# sqlite3 keeps a per-connection cache of prepared statements keyed by SQL text.
+# Hot queries live here as fixed strings so every call hits that cache, and the
+# pool keeps the connections (and their caches) alive between requests.
+STMTS = {
+    "insert_invoice": """
+        INSERT INTO invoices (customer_name, customer_email, number, amount_cents, currency, issued_at, due_at, status)
+        VALUES (?,?,?,?,?,?,?,?)
+    """,
+    "upsert_invoice": """
+        INSERT INTO invoices (customer_name, customer_email, number, amount_cents, currency, issued_at, due_at, status)
+        VALUES (?,?,?,?,?,?,?,?)
+        ON CONFLICT(number) DO UPDATE SET
+            customer_name=excluded.customer_name,
+            customer_email=excluded.customer_email,
+            amount_cents=excluded.amount_cents,
+            currency=excluded.currency,
+            issued_at=excluded.issued_at,
+            due_at=excluded.due_at,
+            status=excluded.status
+    """,
+    "update_invoice": """
+        UPDATE invoices SET customer_name=?, customer_email=?, number=?, amount_cents=?, currency=?, issued_at=?, due_at=?, status=?
+        WHERE id=?
+    """,
+    "invoice_exists": "SELECT id FROM invoices WHERE id=?",
+    "delete_invoice": "DELETE FROM invoices WHERE id = ?",
+    "list_templates": "SELECT * FROM email_templates ORDER BY updated_at DESC",
+    "templates_by_category": "SELECT * FROM email_templates WHERE category = ? ORDER BY updated_at DESC",
+    "search_templates": "SELECT t.* FROM email_templates t JOIN email_templates_fts f ON f.rowid = t.id "
+                        "WHERE email_templates_fts MATCH ? ORDER BY f.rank",
+    "template_by_id": "SELECT subject, body FROM email_templates WHERE id=?",
+    "template_exists": "SELECT id FROM email_templates WHERE id=?",
+    "insert_template": "INSERT INTO email_templates (name, category, subject, body, is_default, created_at, updated_at) VALUES (?,?,?,?,?,?,?)",
+    "update_template": "UPDATE email_templates SET name=?, category=?, subject=?, body=?, is_default=?, updated_at=? WHERE id=?",
+    "delete_template": "DELETE FROM email_templates WHERE id = ?",
+}
 
-    # Invoices (original)
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS invoices (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            customer_name TEXT NOT NULL,
-            customer_email TEXT,
-            number TEXT NOT NULL UNIQUE,
-            amount_cents INTEGER NOT NULL,
-            currency TEXT NOT NULL,
-            issued_at TEXT NOT NULL,
-            due_at TEXT NOT NULL,
-            status TEXT NOT NULL
-        );
-        """
-    )
+def init_db():
+    with pooled() as conn:
+        cur = conn.cursor()
 
-    # Email templates (new)
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS email_templates (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            category TEXT NOT NULL,  -- reminder | followup | promise
-            subject TEXT NOT NULL,
-            body TEXT NOT NULL,
-            is_default INTEGER NOT NULL DEFAULT 0,
-            created_at TEXT NOT NULL,
-            updated_at TEXT NOT NULL
-        );
-        """
-    )
+        # Invoices (original)
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS invoices (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                customer_name TEXT NOT NULL,
+                customer_email TEXT,
+                number TEXT NOT NULL UNIQUE,
+                amount_cents INTEGER NOT NULL,
+                currency TEXT NOT NULL,
+                issued_at TEXT NOT NULL,
+                due_at TEXT NOT NULL,
+                status TEXT NOT NULL
+            );
+            """
+        )
 
-    # Seed invoices (only if empty)
-    cur.execute("SELECT COUNT(*) AS c FROM invoices")
-    if cur.fetchone()["c"] == 0:
-        seed = [
-            ("Acme Co", "ap@acme.test", "INV-2001", 145000, "USD", "2025-07-01T00:00:00Z", "2025-08-01T00:00:00Z", "overdue"),
-            ("Globex", "ar@globex.test", "INV-2002", 56000, "USD", "2025-06-15T00:00:00Z", "2025-07-15T00:00:00Z", "overdue"),
-            ("Umbrella", "ap@umbrella.test", "INV-2003", 99000, "USD", "2025-08-20T00:00:00Z", "2025-09-05T00:00:00Z", "open"),
-            ("Globex", "ap@globex.test", "INV-1002", 54000, "USD", "2025-03-01T00:00:00Z", "2025-04-01T00:00:00Z", "overdue"),
-            ("Acme Co", "ar@acme.test", "INV-1001", 125000, "USD", "2025-02-01T00:00:00Z", "2025-03-15T00:00:00Z", "overdue"),
-        ]
-        cur.executemany(
+        # Email templates (new)
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS email_templates (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                category TEXT NOT NULL,  -- reminder | followup | promise
+                subject TEXT NOT NULL,
+                body TEXT NOT NULL,
+                is_default INTEGER NOT NULL DEFAULT 0,
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            );
             """
-            INSERT INTO invoices (customer_name, customer_email, number, amount_cents, currency, issued_at, due_at, status)
-            VALUES (?,?,?,?,?,?,?,?)
-            """,
-            seed,
         )
-        conn.commit()
 
-    # Seed templates (only if empty)
-    cur.execute("SELECT COUNT(*) AS c FROM email_templates")
-    if cur.fetchone()["c"] == 0:
-        now = datetime.now(timezone.utc).isoformat()
-        templates = [
-            ("Gentle Reminder (Before Due)", "reminder",
-             "Reminder: Invoice {invoice_number} due {due_date}",
-             "Hi {customer_name},\n\nJust a friendly reminder that invoice {invoice_number} for {amount_usd} is due on {due_date}.\n"
-             "If you’ve already sent payment, thank you! Otherwise, please let me know if you need anything from me.\n\nBest,\n{company_name}",
-             1, now, now),
-            ("Overdue Follow-up (1–2 weeks)", "followup",
-             "Overdue: Invoice {invoice_number} ({days_overdue} days)",
-             "Hi {customer_name},\n\nI’m following up on invoice {invoice_number} for {amount_usd}, which is now {days_overdue} days past due (due {due_date}).\n"
-             "Could you share an update on status or an expected payment date?\n\nThanks,\n{company_name}",
-             0, now, now),
-            ("Promise-to-Pay Confirmation", "promise",
-             "Payment plan for invoice {invoice_number}",
-             "Hi {customer_name},\n\nThanks for confirming you’ll pay invoice {invoice_number} ({amount_usd}) by {promised_date}.\n"
-             "I’ll note that on my side. If anything changes, please let me know.\n\nBest,\n{company_name}",
-             0, now, now),
-        ]
-        cur.executemany(
-            "INSERT INTO email_templates (name, category, subject, body, is_default, created_at, updated_at) VALUES (?,?,?,?,?,?,?)",
-            templates,
+        # Seed invoices (only if empty)
+        cur.execute("SELECT COUNT(*) AS c FROM invoices")
+        if cur.fetchone()["c"] == 0:
+            seed = [
+                ("Acme Co", "ap@acme.test", "INV-2001", 145000, "USD", "2025-07-01T00:00:00Z", "2025-08-01T00:00:00Z", "overdue"),
+                ("Globex", "ar@globex.test", "INV-2002", 56000, "USD", "2025-06-15T00:00:00Z", "2025-07-15T00:00:00Z", "overdue"),
+                ("Umbrella", "ap@umbrella.test", "INV-2003", 99000, "USD", "2025-08-20T00:00:00Z", "2025-09-05T00:00:00Z", "open"),
+                ("Globex", "ap@globex.test", "INV-1002", 54000, "USD", "2025-03-01T00:00:00Z", "2025-04-01T00:00:00Z", "overdue"),
+                ("Acme Co", "ar@acme.test", "INV-1001", 125000, "USD", "2025-02-01T00:00:00Z", "2025-03-15T00:00:00Z", "overdue"),
+            ]
+            cur.executemany(STMTS["insert_invoice"], seed)
+            conn.commit()
+
+        # Seed templates (only if empty)
+        cur.execute("SELECT COUNT(*) AS c FROM email_templates")
+        if cur.fetchone()["c"] == 0:
+            now = datetime.now(timezone.utc).isoformat()
+            templates = [
+                ("Gentle Reminder (Before Due)", "reminder",
+                 "Reminder: Invoice {invoice_number} due {due_date}",
+                 "Hi {customer_name},\n\nJust a friendly reminder that invoice {invoice_number} for {amount_usd} is due on {due_date}.\n"
+                 "If you’ve already sent payment, thank you! Otherwise, please let me know if you need anything from me.\n\nBest,\n{company_name}",
+                 1, now, now),
+                ("Overdue Follow-up (1–2 weeks)", "followup",
+                 "Overdue: Invoice {invoice_number} ({days_overdue} days)",
+                 "Hi {customer_name},\n\nI’m following up on invoice {invoice_number} for {amount_usd}, which is now {days_overdue} days past due (due {due_date}).\n"
+                 "Could you share an update on status or an expected payment date?\n\nThanks,\n{company_name}",
+                 0, now, now),
+                ("Promise-to-Pay Confirmation", "promise",
+                 "Payment plan for invoice {invoice_number}",
+                 "Hi {customer_name},\n\nThanks for confirming you’ll pay invoice {invoice_number} ({amount_usd}) by {promised_date}.\n"
+                 "I’ll note that on my side. If anything changes, please let me know.\n\nBest,\n{company_name}",
+                 0, now, now),
+            ]
+            cur.executemany(STMTS["insert_template"], templates)
+
+        # Full-text index over templates, kept in sync by triggers
+        cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'email_templates_fts'")
+        fts_exists = cur.fetchone() is not None
+        cur.execute(
+            """
+            CREATE VIRTUAL TABLE IF NOT EXISTS email_templates_fts
+            USING fts5(name, subject, body, content='email_templates', content_rowid='id');
+            """
         )
+        cur.executescript(
+            """
+            CREATE TRIGGER IF NOT EXISTS email_templates_ai AFTER INSERT ON email_templates BEGIN
+                INSERT INTO email_templates_fts(rowid, name, subject, body) VALUES (new.id, new.name, new.subject, new.body);
+            END;
+            CREATE TRIGGER IF NOT EXISTS email_templates_ad AFTER DELETE ON email_templates BEGIN
+                INSERT INTO email_templates_fts(email_templates_fts, rowid, name, subject, body) VALUES ('delete', old.id, old.name, old.subject, old.body);
+            END;
+            CREATE TRIGGER IF NOT EXISTS email_templates_au AFTER UPDATE ON email_templates BEGIN
+                INSERT INTO email_templates_fts(email_templates_fts, rowid, name, subject, body) VALUES ('delete', old.id, old.name, old.subject, old.body);
+                INSERT INTO email_templates_fts(rowid, name, subject, body) VALUES (new.id, new.name, new.subject, new.body);
+            END;
+            """
+        )
+        if not fts_exists:
+            cur.execute("INSERT INTO email_templates_fts(email_templates_fts) VALUES ('rebuild')")
 
-    conn.commit()
-    conn.close()
+        # Indexes for the /invoices filter/sort keys and the template listing
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_invoices_due ON invoices(due_at)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_invoices_amount ON invoices(amount_cents)")
+        # (status, due_at) was never usable: the status filter is derived from due_at, not the column
+        cur.execute("DROP INDEX IF EXISTS idx_invoices_status_due")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_templates_cat_updated ON email_templates(category, updated_at DESC)")
 
-def parse_iso(s: str):
-    if s.endswith("Z"):
-        return datetime.fromisoformat(s.replace("Z", "+00:00"))
-    try:
-        return datetime.fromisoformat(s)
-    except ValueError:
-        raise HTTPException(status_code=400, detail=f"Invalid ISO datetime: {s}")
-
-def days_overdue(due_at_iso: str) -> int:
-    due = parse_iso(due_at_iso)
-    now = datetime.now(timezone.utc)
-    delta = now - due
-    return max(0, int(delta.days))
-
-def risk_score(days_overdue_val: int, amount_cents: int) -> float:
-    # same shape you had
-    d_norm = min(1.0, days_overdue_val / 120.0)
-    a_norm = min(1.0, amount_cents / 200000.0)
-    return round(max(0.05, min(0.95, 0.45 * d_norm + 0.55 * a_norm)), 2)
+        conn.commit()
+        cur.execute("ANALYZE")
 
 # --------- Models ----------
 class InvoiceIn(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True)
+
     customer_name: str
     customer_email: Optional[str] = None
     number: str
@@ -143,6 +271,14 @@ class InvoiceIn(BaseModel):
     due_at: str
     status: str = "open"
 
+    @field_validator("currency", "status", mode="before")
+    @classmethod
+    def _blank_as_default(cls, v, info):
+        # CSV imports send empty cells rather than omitting the column
+        if v is None or (isinstance(v, str) and not v.strip()):
+            return cls.model_fields[info.field_name].default
+        return v
+
 class TemplateIn(BaseModel):
     name: str
     category: str = Field(pattern="^(reminder|followup|promise)$")
@@ -164,10 +300,36 @@ class RenderIn(BaseModel):
     company_name: Optional[str] = "Accounts Receivable"
     promised_date: Optional[str] = None
 
+# Invoice enrichment, evaluated inside SQLite so that filtering, sorting and
+# paging happen in the engine instead of in Python:
+#   days_overdue = whole days since due_at (never negative)
+#   score        = 0.45 * min(1, days/120) + 0.55 * min(1, amount/200000), clamped to [0.05, 0.95]
+#   impact       = amount_cents * score
+_ENRICHED_CTE = """
+WITH aged AS (
+    SELECT *, MAX(0, CAST(julianday(date('now')) - julianday(date(due_at)) AS INTEGER)) AS days_overdue
+    FROM invoices
+),
+scored AS (
+    SELECT *, py_round(MAX(0.05, MIN(0.95,
+               0.45 * MIN(1.0, days_overdue / 120.0) + 0.55 * MIN(1.0, amount_cents / 200000.0))), 2) AS score
+    FROM aged
+),
+enriched AS (
+    SELECT *, CAST(py_round(amount_cents * score, 0) AS INTEGER) AS impact
+    FROM scored
+)
+"""
+
+_SORT_KEYS = {
+    "amount_desc": "amount_cents",
+    "days_desc": "days_overdue",
+    "impact_desc": "impact",
+}
+
 # --------- Routes (original invoices preserved) ----------
 @app.get("/invoices")
 def list_invoices(
-    response: Response,
     status: Optional[str] = Query(None, description="open|overdue"),
     aging_min: Optional[int] = Query(None, description="30, 60, 90"),
     min_amount: Optional[int] = Query(None, description="amount in cents"),
@@ -175,227 +337,233 @@ def list_invoices(
     sort: str = Query("impact_desc"),
     limit: int = Query(10, ge=1, le=100),
     offset: int = Query(0, ge=0),
+    db: sqlite3.Connection = Depends(get_db),
 ):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM invoices")
+    # Age filters compare due_at itself rather than the computed days_overdue so
+    # they can be answered from idx_invoices_due:
+    #   days_overdue > 0   <=>  due_at < today
+    #   days_overdue >= n  <=>  due_at < today - (n - 1) days
+    where = []
+    params: Dict[str, Any] = {}
+    if status == "overdue":
+        where.append("due_at < date('now')")
+    elif status == "open":
+        where.append("due_at >= date('now')")
+    if aging_min is not None and aging_min > 0:
+        where.append("due_at < date('now', printf('-%d days', :aging_min - 1))")
+        params["aging_min"] = aging_min
+    if min_amount is not None:
+        where.append("amount_cents >= :min_amount")
+        params["min_amount"] = min_amount
+    if max_amount is not None:
+        where.append("amount_cents <= :max_amount")
+        params["max_amount"] = max_amount
+    where_sql = ("WHERE " + " AND ".join(where)) if where else ""
+
+    cur = db.cursor()
+    cur.execute(f"{_ENRICHED_CTE} SELECT COUNT(*) AS c FROM enriched {where_sql}", params)
+    total = cur.fetchone()["c"]
+    cur.execute(
+        f"""
+        {_ENRICHED_CTE}
+        SELECT id, customer_name AS customer, customer_email, number, amount_cents,
+               days_overdue, score, impact, status AS status_raw
+        FROM enriched {where_sql}
+        ORDER BY {_SORT_KEYS.get(sort, "impact")} DESC, id
+        LIMIT :limit OFFSET :offset
+        """,
+        {**params, "limit": limit, "offset": offset},
+    )
     rows = [dict(r) for r in cur.fetchall()]
-    conn.close()
-
-    enriched = []
-    for r in rows:
-        d = days_overdue(r["due_at"])
-        score = risk_score(d, r["amount_cents"])
-        impact = int(round(r["amount_cents"] * score))
-        enriched.append({
-            "id": r["id"],
-            "customer": r["customer_name"],
-            "customer_email": r["customer_email"],   # <— added (non-breaking)
-            "number": r["number"],
-            "amount_cents": r["amount_cents"],
-            "days_overdue": d,
-            "score": score,
-            "impact": impact,
-            "status_raw": r["status"],
-        })
-
-    def filt(x):
-        if status == "overdue" and x["days_overdue"] <= 0:
-            return False
-        if status == "open" and x["days_overdue"] > 0:
-            return False
-        if aging_min is not None and x["days_overdue"] < aging_min:
-            return False
-        if min_amount is not None and x["amount_cents"] < min_amount:
-            return False
-        if max_amount is not None and x["amount_cents"] > max_amount:
-            return False
-        return True
-
-    filtered = [x for x in enriched if filt(x)]
-    if sort == "amount_desc":
-        filtered.sort(key=lambda x: x["amount_cents"], reverse=True)
-    elif sort == "days_desc":
-        filtered.sort(key=lambda x: x["days_overdue"], reverse=True)
-    else:
-        filtered.sort(key=lambda x: x["impact"], reverse=True)
 
-    total = len(filtered)
-    paged = filtered[offset: offset + limit]
-    response.headers["X-Total-Count"] = str(total)
-    return paged
+    # Rows are already plain JSON types, so hand them straight to orjson and
+    # skip FastAPI's jsonable_encoder walk over every field.
+    return ORJSONResponse(rows, headers={"X-Total-Count": str(total)})
 
 @app.post("/invoices")
-def create_invoice(body: InvoiceIn):
-    conn = get_conn()
-    cur = conn.cursor()
+@retry_if_locked
+def create_invoice(body: InvoiceIn, db: sqlite3.Connection = Depends(get_db)):
+    cur = db.cursor()
     try:
-        cur.execute(
-            """
-            INSERT INTO invoices (customer_name, customer_email, number, amount_cents, currency, issued_at, due_at, status)
-            VALUES (?,?,?,?,?,?,?,?)
-            """,
-            (body.customer_name, body.customer_email, body.number, body.amount_cents, body.currency, body.issued_at, body.due_at, body.status),
-        )
-        conn.commit()
+        with WRITE_LOCK:
+            cur.execute(
+                STMTS["insert_invoice"],
+                (body.customer_name, body.customer_email, body.number, body.amount_cents, body.currency, body.issued_at, body.due_at, body.status),
+            )
+            db.commit()
         return {"id": cur.lastrowid}
     except sqlite3.IntegrityError as e:
-        conn.rollback()
+        db.rollback()
         raise HTTPException(status_code=400, detail=f"Invoice number must be unique: {e}")
-    finally:
-        conn.close()
 
 @app.put("/invoices/{invoice_id}")
-def update_invoice(invoice_id: int, body: InvoiceIn):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT id FROM invoices WHERE id=?", (invoice_id,))
+@retry_if_locked
+def update_invoice(invoice_id: int, body: InvoiceIn, db: sqlite3.Connection = Depends(get_db)):
+    cur = db.cursor()
+    cur.execute(STMTS["invoice_exists"], (invoice_id,))
     if not cur.fetchone():
-        conn.close()
         raise HTTPException(status_code=404, detail="Not found")
     try:
-        cur.execute(
-            """
-            UPDATE invoices SET customer_name=?, customer_email=?, number=?, amount_cents=?, currency=?, issued_at=?, due_at=?, status=?
-            WHERE id=?
-            """,
-            (body.customer_name, body.customer_email, body.number, body.amount_cents, body.currency, body.issued_at, body.due_at, body.status, invoice_id),
-        )
-        conn.commit()
+        with WRITE_LOCK:
+            cur.execute(
+                STMTS["update_invoice"],
+                (body.customer_name, body.customer_email, body.number, body.amount_cents, body.currency, body.issued_at, body.due_at, body.status, invoice_id),
+            )
+            db.commit()
         return {"ok": True}
     except sqlite3.IntegrityError as e:
-        conn.rollback()
+        db.rollback()
         raise HTTPException(status_code=400, detail=f"Update failed: {e}")
-    finally:
-        conn.close()
 
 @app.delete("/invoices/{invoice_id}")
-def delete_invoice(invoice_id: int):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM invoices WHERE id = ?", (invoice_id,))
-    conn.commit()
+@retry_if_locked
+def delete_invoice(invoice_id: int, db: sqlite3.Connection = Depends(get_db)):
+    cur = db.cursor()
+    with WRITE_LOCK:
+        cur.execute(STMTS["delete_invoice"], (invoice_id,))
+        db.commit()
     deleted = cur.rowcount
-    conn.close()
     if deleted == 0:
         raise HTTPException(status_code=404, detail="Not found")
     return {"ok": True}
 
-@app.post("/import/invoices")
-async def import_invoices(csv_file: UploadFile = File(...)):
-    if not csv_file.filename.lower().endswith(".csv"):
-        raise HTTPException(status_code=400, detail="Please upload a CSV file.")
-    content = await csv_file.read()
+IMPORT_BATCH_SIZE = 1000
+
+_INVOICE_LIST = TypeAdapter(List[InvoiceIn])
+
+def _validate_import_batch(rows: List[Dict[str, Any]]) -> List[tuple]:
+    # Validate the whole batch in one call; on failure drop only the offending rows
     try:
-        text = content.decode("utf-8")
-    except UnicodeDecodeError:
-        text = content.decode("latin-1")
-    reader = csv.DictReader(io.StringIO(text))
+        invoices = _INVOICE_LIST.validate_python(rows)
+    except ValidationError as e:
+        bad = {err["loc"][0] for err in e.errors()}
+        invoices = _INVOICE_LIST.validate_python([r for i, r in enumerate(rows) if i not in bad])
+    return [
+        (i.customer_name, i.customer_email, i.number, i.amount_cents, i.currency, i.issued_at, i.due_at, i.status)
+        for i in invoices
+    ]
+
+def _import_csv(text: io.TextIOBase, db: sqlite3.Connection) -> int:
+    reader = csv.DictReader(text)
     required = {"customer_name", "customer_email", "number", "amount_cents", "currency", "issued_at", "due_at", "status"}
     if not required.issubset(set([c.strip() for c in reader.fieldnames or []])):
         raise HTTPException(status_code=400, detail=f"CSV must include columns: {', '.join(sorted(required))}")
 
-    conn = get_conn()
-    cur = conn.cursor()
-    inserted = 0
-    for row in reader:
+    cur = db.cursor()
+    with WRITE_LOCK:
+        inserted = 0
+        cur.execute("BEGIN")
+        while True:
+            chunk = list(itertools.islice(reader, IMPORT_BATCH_SIZE))
+            if not chunk:
+                break
+            batch = _validate_import_batch(chunk)
+            cur.executemany(STMTS["upsert_invoice"], batch)
+            inserted += len(batch)
+        db.commit()
+    return inserted
+
+@app.post("/import/invoices")
+@retry_if_locked
+def import_invoices(csv_file: UploadFile = File(...), db: sqlite3.Connection = Depends(get_db)):
+    if not csv_file.filename.lower().endswith(".csv"):
+        raise HTTPException(status_code=400, detail="Please upload a CSV file.")
+    # Parse straight off the spooled upload so memory stays bounded by the batch size.
+    # Decode strictly as UTF-8; if any byte is invalid, roll back and re-import the
+    # whole file as latin-1 (which accepts every byte) so no text is mangled.
+    for encoding in ("utf-8", "latin-1"):
+        csv_file.file.seek(0)
+        text = io.TextIOWrapper(csv_file.file, encoding=encoding, newline="")
         try:
-            cur.execute(
-                """
-                INSERT INTO invoices (customer_name, customer_email, number, amount_cents, currency, issued_at, due_at, status)
-                VALUES (?,?,?,?,?,?,?,?)
-                ON CONFLICT(number) DO UPDATE SET
-                    customer_name=excluded.customer_name,
-                    customer_email=excluded.customer_email,
-                    amount_cents=excluded.amount_cents,
-                    currency=excluded.currency,
-                    issued_at=excluded.issued_at,
-                    due_at=excluded.due_at,
-                    status=excluded.status
-                """,
-                (
-                    row["customer_name"].strip(),
-                    (row.get("customer_email") or "").strip(),
-                    row["number"].strip(),
-                    int(row["amount_cents"]),
-                    (row.get("currency") or "USD").strip(),
-                    row["issued_at"].strip(),
-                    row["due_at"].strip(),
-                    (row.get("status") or "open").strip(),
-                ),
-            )
-            inserted += 1
-        except Exception:
-            continue
-    conn.commit()
-    conn.close()
-    return {"rows_processed": inserted}
+            return {"rows_processed": _import_csv(text, db)}
+        except UnicodeDecodeError:
+            db.rollback()
+        finally:
+            # keep the wrapper from closing the upload file when it is collected
+            text.detach()
 
 # --------- Email Templates (new) ----------
 class _Row(BaseModel):
     id: int
 
+@functools.lru_cache(maxsize=1024)
+def _format_amount_cached(amount_cents: int, code: str) -> str:
+    return f"{(amount_cents/100):,.2f} {code}"
+
 def _format_amount(amount_cents: Optional[int], currency: Optional[str]) -> str:
     if amount_cents is None:
         return ""
-    code = currency or "USD"
-    return f"{(amount_cents/100):,.2f} {code}"
+    return _format_amount_cached(amount_cents, currency or "USD")
+
+_PLACEHOLDER_RE = re.compile(r"\{([a-zA-Z0-9_]+)\}")
 
 def _safe_format(template: str, context: Dict[str, Any]) -> str:
-    out = template
-    for k, v in context.items():
-        out = out.replace("{" + k + "}", "" if v is None else str(v))
-    import re
-    return re.sub(r"\{[a-zA-Z0-9_]+\}", "", out)
+    # Single pass: known placeholders are filled in, unknown ones are dropped
+    def fill(m: "re.Match[str]") -> str:
+        v = context.get(m.group(1))
+        return "" if v is None else str(v)
+    return _PLACEHOLDER_RE.sub(fill, template)
+
+def _fts_query(q: str) -> str:
+    # Quote each word so user input can't inject FTS syntax; `*` keeps prefix matches working
+    return " ".join('"' + w.replace('"', '""') + '"*' for w in q.split())
 
 @app.get("/email/templates")
-def list_templates(q: Optional[str] = None, category: Optional[str] = Query(None, pattern="^(reminder|followup|promise)?$")):
-    conn = get_conn(); cur = conn.cursor()
-    if q:
-        cur.execute("SELECT * FROM email_templates WHERE name LIKE ? OR subject LIKE ? OR body LIKE ? ORDER BY updated_at DESC",
-                    (f"%{q}%", f"%{q}%", f"%{q}%"))
+def list_templates(
+    q: Optional[str] = None,
+    category: Optional[str] = Query(None, pattern="^(reminder|followup|promise)?$"),
+    db: sqlite3.Connection = Depends(get_db),
+):
+    cur = db.cursor()
+    match = _fts_query(q) if q else None
+    if match:
+        cur.execute(STMTS["search_templates"], (match,))
     elif category:
-        cur.execute("SELECT * FROM email_templates WHERE category = ? ORDER BY updated_at DESC", (category,))
+        cur.execute(STMTS["templates_by_category"], (category,))
     else:
-        cur.execute("SELECT * FROM email_templates ORDER BY updated_at DESC")
+        cur.execute(STMTS["list_templates"])
     rows = [dict(r) for r in cur.fetchall()]
-    conn.close()
     for r in rows: r["is_default"] = bool(r["is_default"])
     return {"items": rows}
 
 @app.post("/email/templates")
-def create_template(body: TemplateIn) -> _Row:
+@retry_if_locked
+def create_template(body: TemplateIn, db: sqlite3.Connection = Depends(get_db)) -> _Row:
     now = datetime.now(timezone.utc).isoformat()
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO email_templates (name, category, subject, body, is_default, created_at, updated_at) VALUES (?,?,?,?,?,?,?)",
-        (body.name, body.category, body.subject, body.body, 1 if body.is_default else 0, now, now),
-    )
-    conn.commit()
+    cur = db.cursor()
+    with WRITE_LOCK:
+        cur.execute(
+            STMTS["insert_template"],
+            (body.name, body.category, body.subject, body.body, 1 if body.is_default else 0, now, now),
+        )
+        db.commit()
     i = cur.lastrowid
-    conn.close()
     return _Row(id=i)
 
 @app.put("/email/templates/{template_id}")
-def update_template(template_id: int, body: TemplateIn):
+@retry_if_locked
+def update_template(template_id: int, body: TemplateIn, db: sqlite3.Connection = Depends(get_db)):
     now = datetime.now(timezone.utc).isoformat()
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute("SELECT id FROM email_templates WHERE id=?", (template_id,))
+    cur = db.cursor()
+    cur.execute(STMTS["template_exists"], (template_id,))
     if not cur.fetchone():
-        conn.close()
         raise HTTPException(status_code=404, detail="Not found")
-    cur.execute(
-        "UPDATE email_templates SET name=?, category=?, subject=?, body=?, is_default=?, updated_at=? WHERE id=?",
-        (body.name, body.category, body.subject, body.body, 1 if body.is_default else 0, now, template_id),
-    )
-    conn.commit(); conn.close()
+    with WRITE_LOCK:
+        cur.execute(
+            STMTS["update_template"],
+            (body.name, body.category, body.subject, body.body, 1 if body.is_default else 0, now, template_id),
+        )
+        db.commit()
     return {"ok": True}
 
 @app.delete("/email/templates/{template_id}")
-def delete_template(template_id: int):
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute("DELETE FROM email_templates WHERE id = ?", (template_id,))
-    conn.commit(); deleted = cur.rowcount; conn.close()
+@retry_if_locked
+def delete_template(template_id: int, db: sqlite3.Connection = Depends(get_db)):
+    cur = db.cursor()
+    with WRITE_LOCK:
+        cur.execute(STMTS["delete_template"], (template_id,))
+        db.commit()
+    deleted = cur.rowcount
     if deleted == 0:
         raise HTTPException(status_code=404, detail="Not found")
     return {"ok": True}
@@ -405,9 +573,9 @@ def render_template(body: RenderIn):
     subject = body.subject or ""
     text = body.body or ""
     if body.template_id:
-        conn = get_conn(); cur = conn.cursor()
-        cur.execute("SELECT subject, body FROM email_templates WHERE id=?", (body.template_id,))
-        row = cur.fetchone(); conn.close()
+        # Only template lookups touch the database; inline subject/body renders skip the pool
+        with pooled() as db:
+            row = db.execute(STMTS["template_by_id"], (body.template_id,)).fetchone()
         if not row:
             raise HTTPException(status_code=404, detail="Template not found")
         subject = row["subject"]; text = row["body"]